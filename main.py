@@ -1,26 +1,26 @@
 #!/usr/bin/python3
 
 import argparse
-import datetime
 import enum
-import itertools
+import functools
+import json
 import logging
 import os
 import sys
-import urllib
+import time
+import urllib.parse
 
 from dataclasses import dataclass, field
-from dataclasses_json import dataclass_json, CatchAll, Undefined
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 
-from telegram import constants, Update, Message
+from telegram import constants, Update, Message, MessageEntity
+from telegram.error import TelegramError
 from telegram.ext import filters, ApplicationBuilder, CallbackContext, CommandHandler, \
     MessageHandler
 
 from url_normalize import url_normalize
 
 
-@dataclass_json
 @dataclass
 class WebhookConfig:
     hostname: str
@@ -29,7 +29,6 @@ class WebhookConfig:
     port: int = field(default_factory=lambda: int(os.environ["PORT"]))
 
 
-@dataclass_json
 @dataclass
 class Config:
     token: str
@@ -46,23 +45,11 @@ class Verdict(enum.IntEnum):
     SCAM = 20
 
 
-@dataclass
+@dataclass(frozen=True)
 class FilterResult:
     verdict: Verdict
     explanation: Optional[List[str]] = None
 
-    @classmethod
-    def empty(cls):
-        return cls(Verdict.SAFE)
-
-    def append(self, other: "FilterResult") -> "FilterResult":
-        v = max(self.verdict, other.verdict)
-        if self.explanation or other.explanation:
-            e = (self.explanation or []) + (other.explanation or [])
-        else:
-            e = None
-        return FilterResult(v, explanation=e)
-
     def __str__(self):
         res = f"{self.verdict.name}"
         if self.explanation:
@@ -70,35 +57,45 @@ class FilterResult:
         return res
 
 
+_SAFE_RESULT = FilterResult(Verdict.SAFE)
+
+
 @dataclass
 class BlocklistFilter:
-    blocklist: Set[str]
+    blocklist: FrozenSet[str]
+
+    def __post_init__(self):
+        # Membership checks must stay hashed; a list here would make every probe O(n).
+        assert isinstance(self.blocklist, (set, frozenset))
 
     @classmethod
     def from_config(cls, filename: str):
         with open(filename, "r") as f:
-            res = cls(set(f.read().splitlines()))
-        logging.info(f"Blocklist: {res.blocklist}")
+            res = cls(frozenset(
+                sys.intern(line.strip().lower()) for line in f if line.strip()))
+        logging.info("Blocklist: %s", res.blocklist)
         return res
 
     def assess(self, update: Update):
-        links = set()
-        for msg in [update.message, update.edited_message]:
-            if msg is not None and msg.from_user is not None:
-                message_from = msg.from_user.id
-                reply_to = msg.message_id
-                links |= _collect_all_links(msg)
-                break
-        isec = links & self.blocklist
-        if len(isec):
+        msg = update.message or update.edited_message
+        if msg is None or msg.from_user is None:
+            return _SAFE_RESULT
+        links = _collect_all_links(msg)
+        if not links.isdisjoint(self.blocklist):
+            isec = links & self.blocklist
             return FilterResult(
                 verdict=Verdict.SCAM, explanation=["Message mentions blocked content: " + " ".join(
                     sorted(isec))])
-        return FilterResult(Verdict.SAFE)
+        return _SAFE_RESULT
 
 
 FILTERS = {"blocklist": BlocklistFilter, }
 
+# Seconds to trust a cached chat administrator list.
+_ADMIN_CACHE_TTL = 300
+# Minimum seconds between warnings posted to the same chat.
+_WARNING_INTERVAL = 60
+
 
 def _make_argparser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(
@@ -107,35 +104,88 @@ def _make_argparser() -> argparse.ArgumentParser:
     return p
 
 
+@functools.lru_cache(maxsize=4096)
 def _host(url: str) -> str:
-    url = url_normalize(url)
-    return urllib.parse.urlparse(url).netloc
+    url = url.strip()
+    if "://" not in url and url.isascii() and not any(c in url for c in "/?#@:%"):
+        # Bare domain: already a host, nothing to scan.
+        return sys.intern(url.lower())
+    start = url.find("://")
+    start = 0 if start < 0 else start + 3
+    end = len(url)
+    for c in "/?#":
+        i = url.find(c, start)
+        if 0 <= i < end:
+            end = i
+    netloc = url[start:end].rpartition("@")[2]
+    if not netloc.isascii() or "%" in netloc:
+        # IDN or percent-encoded host: let url_normalize do the heavy lifting.
+        return sys.intern(urllib.parse.urlparse(url_normalize(url)).hostname or "")
+    colon = netloc.rfind(":")
+    if colon > netloc.rfind("]"):
+        netloc = netloc[:colon]
+    return sys.intern(netloc.lower())
+
+
+def _entity_text(text_u16: bytes, e: MessageEntity) -> str:
+    return text_u16[2 * e.offset:2 * (e.offset + e.length)].decode("utf-16-le")
+
+
+def _url_host(text_u16: bytes, e: MessageEntity) -> str:
+    link = _entity_text(text_u16, e)
+    logging.debug("Extracted URL: %s", link)
+    return _host(link)
+
+
+def _text_link_host(text_u16: bytes, e: MessageEntity) -> str:
+    link = e.url
+    logging.debug("Extracted text link: %s", link)
+    return _host(link)
+
+
+def _mention(text_u16: bytes, e: MessageEntity) -> str:
+    mention = _entity_text(text_u16, e).lower()
+    logging.debug("Extracted mention: %s", mention)
+    return mention
+
+
+_LINK_EXTRACTORS: Dict[str, Callable[[bytes, MessageEntity], str]] = {
+    "url": _url_host,
+    "text_link": _text_link_host,
+    "mention": _mention,
+}
 
 
 def _collect_all_links(msg: Message) -> Set[str]:
     res: Set[str] = set()
-    for e in itertools.chain(msg.entities, msg.caption_entities):
-        if e.type == "url":
-            link = msg.parse_entity(e)
-            logging.debug(f"Extracted URL: {link}")
-            res.add(_host(link))
-        elif e.type == "text_link":
-            link = e.url
-            logging.debug(f"Extracted text link: {link}")
-            res.add(_host(link))
-        elif e.type == "mention":
-            mention = msg.parse_entity(e).lower()
-            logging.debug(f"Extracted mention: {mention}")
-            res.add(mention)
+    seen_spans: Set[Tuple[int, str, int, int]] = set()
+    sources = ((msg.entities, msg.text), (msg.caption_entities, msg.caption))
+    for src, (entities, text) in enumerate(sources):
+        if not entities:
+            continue
+        # Entity offsets are in UTF-16 code units; encode once instead of per parse_entity().
+        text_u16 = text.encode("utf-16-le") if text else b""
+        for e in entities:
+            extract = _LINK_EXTRACTORS.get(e.type)
+            if extract is None:
+                continue
+            key = (src, e.type, e.offset, e.length)
+            if key in seen_spans:
+                continue
+            seen_spans.add(key)
+            res.add(extract(text_u16, e))
     return res
 
 
 class Bot:
     def __init__(self, cfg: Config) -> None:
         self._cfg: Config = cfg
+        self._warning: str = cfg.warning
+        self._webhook: Optional[WebhookConfig] = cfg.webhook
         self._blocklist: Set[str] = set()
-        self._filters = self._load_filters()
-        self._last_post: Optional[datetime.datetime] = None
+        self._assessors = self._load_filters()
+        self._last_post: Dict[int, float] = {}
+        self._admin_cache: Dict[int, Tuple[float, Set[int]]] = {}
 
     def _load_filters(self):
         res = []
@@ -143,37 +193,63 @@ class Bot:
             clname = f["filter"]
             parms = {k: v for k, v in f.items() if k != "filter"}
             res.append(FILTERS[clname].from_config(**parms))
-        return res
+        return tuple(inst.assess for inst in res)
 
     async def _handle_scam(
             self, context: CallbackContext.DEFAULT_TYPE, chat_id: int, message_from: int,
             reply_to: int):
-        admins = await context.bot.get_chat_administrators(chat_id)
-        admin_ids = [a.user.id for a in admins]
+        now = time.monotonic()
+        entry = self._admin_cache.get(chat_id)
+        if entry is not None and now - entry[0] < _ADMIN_CACHE_TTL:
+            admin_ids = entry[1]
+        else:
+            admins = await context.bot.get_chat_administrators(chat_id)
+            admin_ids = {a.user.id for a in admins}
+            self._admin_cache = {
+                k: v for k, v in self._admin_cache.items() if now - v[0] < _ADMIN_CACHE_TTL}
+            self._admin_cache[chat_id] = (now, admin_ids)
         if context.bot.id in admin_ids:
             logging.info("Admin mode: deleting the message")
-            await context.bot.delete_message(chat_id=chat_id, message_id=reply_to)
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=reply_to)
+                return
+            except TelegramError as e:
+                # The cached admin list may be stale; forget it and warn instead.
+                logging.warning("Admin mode: failed to delete the message: %s", e)
+                self._admin_cache.pop(chat_id, None)
+        last = self._last_post.get(chat_id)
+        if last is not None and now - last < _WARNING_INTERVAL:
+            logging.info("Canary mode: throttled a warning")
         else:
-            now = datetime.datetime.now()
-            if self._last_post is not None and (now - self._last_post).total_seconds() < 60:
-                logging.info("Canary mode: throttled a warning")
-            else:
-                logging.info("Canary mode: issuing a warning")
-                await context.bot.send_message(
-                    chat_id=chat_id, text=self._cfg.warning, reply_to_message_id=reply_to)
-                self._last_post = now
+            logging.info("Canary mode: issuing a warning")
+            await context.bot.send_message(
+                chat_id=chat_id, text=self._warning, reply_to_message_id=reply_to)
+            self._last_post = {
+                k: v for k, v in self._last_post.items() if now - v < _WARNING_INTERVAL}
+            self._last_post[chat_id] = now
 
     async def _handle_message(self, update: Update, context: CallbackContext.DEFAULT_TYPE):
         if update.message is None and update.edited_message is None:
             return
 
         msg = update.message or update.edited_message
+        if not msg.entities and not msg.caption_entities:
+            return
 
-        verdict = FilterResult.empty()
-        for f in self._filters:
-            verdict = verdict.append(f.assess(update))
+        best = Verdict.SAFE
+        evidence: List[str] = []
+        for assess in self._assessors:
+            r = assess(update)
+            if r.verdict > best:
+                best = r.verdict
+            if r.explanation:
+                evidence.extend(r.explanation)
+        if best == Verdict.SAFE and not evidence:
+            verdict = _SAFE_RESULT
+        else:
+            verdict = FilterResult(best, evidence or None)
 
-        logging.info(f"Verdict: {verdict}")
+        logging.info("Verdict: %s", verdict)
 
         if verdict.verdict == Verdict.SCAM:
             await self._handle_scam(
@@ -181,17 +257,24 @@ class Bot:
 
     def start(self):
         app = ApplicationBuilder().token(self._cfg.token).build()
-        app.add_handler(MessageHandler(filters.ALL, self._handle_message))
-        if self._cfg.webhook is None:
+        has_links = (
+            filters.Entity(constants.MessageEntityType.URL)
+            | filters.Entity(constants.MessageEntityType.TEXT_LINK)
+            | filters.Entity(constants.MessageEntityType.MENTION)
+            | filters.CaptionEntity(constants.MessageEntityType.URL)
+            | filters.CaptionEntity(constants.MessageEntityType.TEXT_LINK)
+            | filters.CaptionEntity(constants.MessageEntityType.MENTION))
+        app.add_handler(MessageHandler(has_links, self._handle_message))
+        if self._webhook is None:
             logging.info("Starting in polling mode")
             app.run_polling()
         else:
-            webhook_url = f"{self._cfg.webhook.hostname}/{self._cfg.webhook.path}"
-            addr = self._cfg.webhook.address
-            port = self._cfg.webhook.port
+            webhook_url = f"{self._webhook.hostname}/{self._webhook.path}"
+            addr = self._webhook.address
+            port = self._webhook.port
             logging.info(f"Starting webhook at {webhook_url}; backend at {addr}:{port}")
             app.run_webhook(
-                listen=addr, port=port, url_path=self._cfg.webhook.path, webhook_url=webhook_url)
+                listen=addr, port=port, url_path=self._webhook.path, webhook_url=webhook_url)
 
 
 def main(args: List[str]) -> None:
@@ -199,7 +282,9 @@ def main(args: List[str]) -> None:
 
     with open(_args.k, "r") as config:
         cfg_str = config.read()
-    cfg: Config = Config.schema().loads(cfg_str)
+    raw = json.loads(cfg_str)
+    wh = raw.pop("webhook", None)
+    cfg: Config = Config(**raw, webhook=WebhookConfig(**wh) if wh else None)
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=cfg.log_level)
 